@@ -16,16 +16,25 @@
 # Lint as: python3
 """Classes for RL training in Trax."""
 
+import collections
+import functools
+import itertools
 import os
+import queue
+import threading
+import weakref
+
 import numpy as np
 import tensorflow as tf
 
 from trax import layers as tl
 from trax import lr_schedules as lr
+from trax import math
 from trax import shapes
 from trax import supervised
 from trax.math import numpy as jnp
 from trax.rl import advantages as rl_advantages
+from trax.rl import task as rl_task
 from trax.rl import training as rl_training
 
 
@@ -51,6 +60,9 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
                added_policy_slice_length=0,
                n_replay_epochs=1,
                scale_value_targets=False,
+               value_eval_prefetch=1,
+               value_eval_buffer_size=0,
+               value_eval_dtype=None,
                **kwargs):  # Arguments of PolicyTrainer come here.
     """Configures the actor-critic Trainer.
 
@@ -77,8 +89,24 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
         only makes sense for off-policy algorithms
      scale_value_targets: whether to scale targets for the value function by
         1 / (1 - gamma)
+     value_eval_prefetch: how many trajectory batches to evaluate the target
+        value network on in a single call, at least 1 (default); larger values
+        pay off when many batches are drawn per target network update, since
+        results computed with an outdated target network are discarded
+     value_eval_buffer_size: how many value and policy batches to prepare
+        ahead in a background thread; 0 (default) prepares them in the training
+        thread; each train and eval stream of the value and policy trainers
+        uses its own thread, and the threads are stopped at the end of every
+        epoch, before new trajectories are collected
+     value_eval_dtype: if set (e.g. to jnp.bfloat16), weights of the target
+        value network are stored in this dtype and observations are cast to it
+        before evaluating the network; values are cast back to float32, so
+        targets and training stay in full precision
      **kwargs: arguments for PolicyTrainer super-class
     """
+    if value_eval_prefetch < 1:
+      raise ValueError(
+          f'value_eval_prefetch must be at least 1, got {value_eval_prefetch}.')
     self._n_shared_layers = n_shared_layers
     self._value_batch_size = value_batch_size
     self._value_train_steps_per_epoch = value_train_steps_per_epoch
@@ -92,6 +120,9 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
     self._max_slice_length = kwargs.get('max_slice_length', 1)
     self._added_policy_slice_length = added_policy_slice_length
     self._n_replay_epochs = n_replay_epochs
+    self._value_eval_prefetch = value_eval_prefetch
+    self._value_eval_buffer_size = value_eval_buffer_size
+    self._value_eval_dtype = value_eval_dtype
 
     if scale_value_targets:
       self._value_network_scale = 1 / (1 - self._task.gamma)
@@ -100,6 +131,22 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
 
     self._value_eval_model = value_model(mode='eval')
     self._value_eval_model.init(self._value_model_signature)
+    # Weights and state of the target network are replaced as a whole, so that
+    # batches can be prepared in a background thread while they are updated.
+    # They are passed to the jitted functions as arguments, so updating them
+    # does not trigger recompilation.
+    self._set_target_value_network(
+        self._value_eval_model.weights, self._value_eval_model.state)
+    self._value_eval_jit = math.jit(self._value_eval_fn)
+    self._value_targets_jit = math.jit(self._value_targets_fn)
+    self._value_eval_rng = math.random.get_prng(0)
+    # Jitted calls may come from several producer threads; see
+    # _run_value_eval_jit.
+    self._value_eval_lock = threading.Lock()
+    # Incremented on every target network update, to detect outdated batches.
+    self._value_eval_generation = 0
+    # Streams running in background threads, stopped in close().
+    self._background_streams = weakref.WeakSet()
 
     # Initialize training of the value function.
     value_output_dir = kwargs.get('output_dir', None)
@@ -139,42 +186,184 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
       )
     return [-(ep + 1) for ep in range(self._n_replay_epochs)]
 
+  def _value_eval_fn(self, observations, mask, weights, state, rng):
+    """Computes scaled values of shape [batch_size, length]; to be jitted.
+
+    Batches are padded to a fixed length, so values of padding timesteps are
+    zeroed out by the mask instead of being sliced away.
+
+    Args:
+      observations: observations of shape [batch_size, length, ...]
+      mask: 0/1 mask of shape [batch_size, length], 0 for padding
+      weights: weights of the target value network
+      state: state of the target value network
+      rng: random number generator for the target value network
+
+    Returns:
+      an array of shape [batch_size, length] with values of the observations
+    """
+    # Weights are already cast in _set_target_value_network. Observations are
+    # cast here if the caller has not done it on the host.
+    observations = _cast_floating(observations, self._value_eval_dtype)
+    values, _ = self._value_eval_model.pure_fn(
+        observations, weights, state, rng)
+    # The scale is applied here rather than folded into the network weights:
+    # the network is trained on unscaled targets, and within the jit the
+    # multiplication fuses with the surrounding elementwise ops.
+    values = values.astype(jnp.float32) * self._value_network_scale
+    values = jnp.squeeze(values, axis=2)  # Remove the singleton depth dim.
+    return values * mask
+
+  def _advantages_fn(self, rewards, returns, values):
+    """Computes advantages of shape [batch_size, length]; to be jitted."""
+    # How much TD to use is determined by the added policy slice length,
+    # as the policy batches need to be this much longer to calculate TD.
+    return self._advantage_estimator(
+        rewards, returns, values,
+        gamma=self._task.gamma,
+        n_extra_steps=self._added_policy_slice_length,
+    )
+
+  def _value_targets_fn(self, observations, rewards, returns, mask,
+                        weights, state, rng):
+    """Computes a value model batch from a trajectory batch; to be jitted."""
+    values = self._value_eval_fn(observations, mask, weights, state, rng)
+    # Calculate targets based on the advantages over the target network - this
+    # allows TD learning for value networks.
+    advantages = self._advantages_fn(rewards, returns, values)
+    length = advantages.shape[1]
+    target_returns = values[:, :length] + advantages
+
+    # Insert an extra depth dimension, so the target shape is consistent with
+    # the network output shape.
+    return (
+        # Inputs: observations.
+        observations[:, :length],
+        # Targets: computed returns.
+        target_returns[:, :, None] / self._value_network_scale,
+        # Mask to zero-out padding.
+        mask[:, :length, None],
+    )
+
+  def _run_value_eval_jit(self, jit_fn, *args):
+    """Runs a jitted function of the target value network on the given args."""
+    (weights, state) = self._value_eval_weights_and_state
+    with self._value_eval_lock:
+      output = jit_fn(*args, weights, state, self._value_eval_rng)
+      # Tracing goes through Layer.pure_fn, which caches the traced weights and
+      # state on the model. Put the concrete ones back.
+      if self._value_eval_model.weights is not weights:
+        self._value_eval_model.weights = weights
+        self._value_eval_model.state = state
+    return output
+
+  def _value_eval(self, observations, mask):
+    """Runs the jitted target value network on a batch of observations."""
+    # Only the target network reads these observations, so casting them on the
+    # host also shrinks the copy to the device.
+    observations = _cast_floating(observations, self._value_eval_dtype)
+    return self._run_value_eval_jit(self._value_eval_jit, observations, mask)
+
+  def _set_target_value_network(self, weights, state):
+    """Sets weights and state of the target network, cast to its dtype."""
+    weights = math.nested_map(
+        lambda x: _cast_floating(x, self._value_eval_dtype), weights)
+    self._value_eval_weights_and_state = (weights, state)
+
+  def _update_target_value_network(self):
+    """Copies weights and state of the value trainer to the target network."""
+    self._set_target_value_network(
+        self._value_trainer.model_weights, self._value_trainer.model_state)
+    # Bump the generation only after the update, so batches tagged with the
+    # new generation are never computed with the old target network.
+    self._value_eval_generation += 1
+
+  def _prefetched_value_eval(self, trajectory_batches, value_eval_fn):
+    """Evaluates value_eval_fn on several trajectory batches at a time.
+
+    See _grouped_value_eval for how the batches are evaluated.
+
+    Args:
+      trajectory_batches: a stream of TrajectoryNp batches
+      value_eval_fn: function from a TrajectoryNp batch to a (nested) output
+        of arrays with the batch as their leading dimension
+
+    Yields:
+      triples (generation, trajectory_batch, value_eval_fn(trajectory_batch)),
+      where generation is the generation of the target network used
+    """
+    while True:
+      generation = self._value_eval_generation
+      batches = list(
+          itertools.islice(trajectory_batches, self._value_eval_prefetch))
+      if not batches:
+        return
+      outputs = _grouped_value_eval(batches, value_eval_fn)
+      for (batch, output) in zip(batches, outputs):
+        yield (generation, batch, output)
+
+  def _trajectory_sampling_rng(self):
+    """Returns the random state for sampling trajectories for a new stream."""
+    if self._value_eval_buffer_size == 0:
+      return None  # Sample in the training thread, like other streams.
+    # Each producer thread samples with its own random state, seeded from the
+    # global one in the training thread, so seeded runs stay reproducible.
+    return np.random.RandomState(np.random.randint(2**31 - 1))
+
+  def _stop_background_streams(self):
+    """Stops all background producer threads and waits for them to finish."""
+    for stream in list(self._background_streams):
+      stream.close()
+
+  def _value_eval_stream(self, trajectory_batches, value_eval_fn):
+    """Yields trajectory batches with value_eval_fn evaluated on them.
+
+    Batches are prepared by _prefetched_value_eval, in a background thread if
+    value_eval_buffer_size > 0. Batches computed with an outdated target network
+    are discarded.
+
+    Args:
+      trajectory_batches: a stream of TrajectoryNp batches
+      value_eval_fn: function from a TrajectoryNp batch to a (nested) output
+        of arrays with the batch as their leading dimension
+
+    Yields:
+      pairs (trajectory_batch, value_eval_fn(trajectory_batch))
+    """
+    stream = self._prefetched_value_eval(trajectory_batches, value_eval_fn)
+    if self._value_eval_buffer_size > 0:
+      stream = _background_stream(stream, self._value_eval_buffer_size)
+      self._background_streams.add(stream)
+    # A stopped background stream just ends here; the supervised Trainer then
+    # restarts the value or policy batch stream with a new producer.
+    for (generation, batch, output) in stream:
+      if generation == self._value_eval_generation:
+        yield (batch, output)
+
   def value_batches_stream(self):
     """Use the RLTask self._task to create inputs to the value model."""
     max_slice_length = self._max_slice_length + self._added_policy_slice_length
-    for np_trajectory in self._task.trajectory_batch_stream(
+    trajectory_batches = self._task.trajectory_batch_stream(
         self._value_batch_size,
         max_slice_length=max_slice_length,
         min_slice_length=(1 + self._added_policy_slice_length),
         epochs=self._replay_epochs,
-    ):
-      values = self._value_eval_model(
-          np_trajectory.observations, n_accelerators=1
-      ) * self._value_network_scale
-      values = np.squeeze(values, axis=2)  # Remove the singleton depth dim.
-
-      # TODO(pkozakowski): Add some shape assertions and docs.
-      # Calculate targets based on the advantages over the target network - this
-      # allows TD learning for value networks.
-      advantages = self._advantage_estimator(
-          np_trajectory.rewards, np_trajectory.returns, values,
-          gamma=self._task.gamma,
-          n_extra_steps=self._added_policy_slice_length,
-      )
-      length = advantages.shape[1]
-      values = values[:, :length]
-      target_returns = values + advantages
-
-      # Insert an extra depth dimension, so the target shape is consistent with
-      # the network output shape.
-      yield (
-          # Inputs: observations.
-          np_trajectory.observations[:, :length],
-          # Targets: computed returns.
-          target_returns[:, :, None] / self._value_network_scale,
-          # Mask to zero-out padding.
-          np_trajectory.mask[:, :length, None],
+        # Fixed shapes avoid recompiling the jitted functions for each length.
+        padding_length=max_slice_length,
+        rng=self._trajectory_sampling_rng(),
+    )
+    def value_targets(np_trajectory):
+      return self._run_value_eval_jit(
+          self._value_targets_jit,
+          np_trajectory.observations,
+          np_trajectory.rewards,
+          np_trajectory.returns,
+          np_trajectory.mask,
       )
+    # TODO(pkozakowski): Add some shape assertions and docs.
+    for (_, batch) in self._value_eval_stream(
+        trajectory_batches, value_targets):
+      yield batch
 
   def policy_inputs(self, trajectory, values):
     """Create inputs to policy model from a TrajectoryNp and values.
@@ -195,15 +384,17 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
     """Use the RLTask self._task to create inputs to the policy model."""
     # Maximum slice length for policy is max_slice_len + the added policy len.
     max_slice_length = self._max_slice_length + self._added_policy_slice_length
-    for np_trajectory in self._task.trajectory_batch_stream(
+    trajectory_batches = self._task.trajectory_batch_stream(
         self._policy_batch_size,
         epochs=self._replay_epochs,
         max_slice_length=max_slice_length,
-        include_final_state=False):
-      values = self._value_eval_model(
-          np_trajectory.observations, n_accelerators=1
-      ) * self._value_network_scale
-      values = np.squeeze(values, axis=2)  # Remove the singleton depth dim.
+        include_final_state=False,
+        padding_length=max_slice_length,
+        rng=self._trajectory_sampling_rng())
+    def value_eval(np_trajectory):
+      return self._value_eval(np_trajectory.observations, np_trajectory.mask)
+    for (np_trajectory, values) in self._value_eval_stream(
+        trajectory_batches, value_eval):
       if len(values.shape) != 2:
         raise ValueError('Values are expected to have shape ' +
                          '[batch_size, length], got: %s' % str(values.shape))
@@ -224,8 +415,7 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
       )
 
     # Update the target value network.
-    self._value_eval_model.weights = self._value_trainer.model_weights
-    self._value_eval_model.state = self._value_trainer.model_state
+    self._update_target_value_network()
 
     n_value_evals = rl_training.remaining_evals(
         self._value_trainer.step,
@@ -256,9 +446,10 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
           0, self._n_shared_layers, self._value_trainer, self._policy_trainer
       )
 
-    # Update the target value network.
-    self._value_eval_model.weights = self._value_trainer.model_weights
-    self._value_eval_model.state = self._value_trainer.model_state
+    # Update the target value network. Policy batches are computed with the
+    # freshly trained value network, so values from the value batches above
+    # cannot be reused for them.
+    self._update_target_value_network()
 
     for _ in range(n_policy_evals):
       self._policy_trainer.train_epoch(
@@ -266,7 +457,13 @@ class ActorCriticTrainer(rl_training.PolicyTrainer):
           self._policy_eval_steps,
       )
 
+    # Producers read the task's trajectories, so they must not run while new
+    # trajectories are collected.
+    self._stop_background_streams()
+
   def close(self):
+    # Stop the background threads before closing the trainers they feed.
+    self._stop_background_streams()
     self._value_trainer.close()
     super().close()
 
@@ -275,29 +472,147 @@ def _copy_model_weights_and_state(  # pylint: disable=invalid-name
     start, end, from_trainer, to_trainer, copy_optimizer_slots=False
 ):
   """Copy model weights[start:end] from from_trainer to to_trainer."""
-  from_weights = from_trainer.model_weights
-  to_weights = to_trainer.model_weights
-  shared_weights = from_weights[start:end]
-  to_weights[start:end] = shared_weights
-  to_trainer.model_weights = to_weights
-
-  from_state = from_trainer.model_state
-  to_state = to_trainer.model_state
-  shared_state = from_state[start:end]
-  to_state[start:end] = shared_state
-  to_trainer.model_state = to_state
+  def copy_slice(from_tree, to_tree):
+    return to_tree[:start] + from_tree[start:end] + to_tree[end:]
+
+  if from_trainer.n_devices == to_trainer.n_devices:
+    # Copy the replicated arrays as they are, so they stay on the devices
+    # instead of being unreplicated and replicated again.
+    to_trainer.replicated_model_weights = copy_slice(
+        from_trainer.replicated_model_weights,
+        to_trainer.replicated_model_weights)
+    to_trainer.replicated_model_state = copy_slice(
+        from_trainer.replicated_model_state,
+        to_trainer.replicated_model_state)
+  else:
+    to_trainer.model_weights = copy_slice(
+        from_trainer.model_weights, to_trainer.model_weights)
+    to_trainer.model_state = copy_slice(
+        from_trainer.model_state, to_trainer.model_state)
 
   if copy_optimizer_slots:
-    # TODO(lukaszkaiser): make a nicer API in Trainer to support this.
-    # Currently we use the hack below. Note [0] since that's the model w/o loss.
-    # pylint: disable=protected-access
-    from_slots = from_trainer._opt_state.slots[0][start:end]
-    to_slots = to_trainer._opt_state.slots[0]
-    # The lines below do to_slots[start:end] = from_slots, but on tuples.
-    new_slots = to_slots[:start] + from_slots[start:end] + to_slots[end:]
-    new_slots = tuple([new_slots] + list(to_trainer._opt_state.slots[1:]))
-    to_trainer._opt_state = to_trainer._opt_state._replace(slots=new_slots)
-    # pylint: enable=protected-access
+    to_trainer.set_model_slots(
+        start, end, from_trainer.get_model_slots(start, end))
+
+
+def _grouped_value_eval(batches, value_eval_fn):
+  """Evaluates value_eval_fn on a list of TrajectoryNp batches.
+
+  Batches with the same shapes are concatenated, so value_eval_fn runs once per
+  group instead of once per batch.
+
+  Args:
+    batches: a list of TrajectoryNp batches
+    value_eval_fn: function from a TrajectoryNp batch to a (nested) output
+      of arrays with the batch as their leading dimension
+
+  Returns:
+    a list of outputs of value_eval_fn, one per batch, in the order of batches
+  """
+  groups = collections.defaultdict(list)
+  for (i, batch) in enumerate(batches):
+    groups[tuple(x.shape for x in batch)].append(i)
+  outputs = [None] * len(batches)
+  for indices in groups.values():
+    merged_output = value_eval_fn(
+        _concatenate_trajectory_batches([batches[i] for i in indices]))
+    start = 0
+    for i in indices:
+      end = start + batches[i].observations.shape[0]
+      outputs[i] = _slice_batch(merged_output, start, end)
+      start = end
+  return outputs
+
+
+def _cast_floating(x, dtype):
+  """Casts x to dtype if x is a floating-point array and dtype is set."""
+  if dtype is not None and jnp.issubdtype(x.dtype, jnp.floating):
+    return x.astype(dtype)
+  return x
+
+
+def _concatenate_trajectory_batches(batches):
+  """Concatenates TrajectoryNp batches of equal shapes along the batch axis."""
+  return rl_task.TrajectoryNp(
+      *[np.concatenate(xs, axis=0) for xs in zip(*batches)])
+
+
+def _slice_batch(batch, start, end):
+  """Slices a (nested) batch of arrays along the leading axis."""
+  return math.nested_map(lambda x: x[start:end], batch)
+
+
+def _background_stream(stream, buffer_size):
+  """Iterates over stream in a background thread, buffering buffer_size items.
+
+  The thread stops when the returned generator is closed or garbage-collected;
+  closing waits for the item being prepared to finish.
+  Exceptions raised by stream are re-raised in the consuming thread.
+
+  Args:
+    stream: an iterable to consume
+    buffer_size: maximum number of items prepared ahead
+
+  Yields:
+    items of stream, in order
+  """
+  buffer = queue.Queue(maxsize=buffer_size)
+  stop = threading.Event()
+
+  def put(entry):
+    while not stop.is_set():
+      try:
+        buffer.put(entry, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for item in stream:
+        if not put((False, item)):
+          return
+    except Exception as e:  # pylint: disable=broad-except
+      put((True, e))
+      return
+    put((True, None))  # End of stream.
+
+  thread = threading.Thread(target=produce, daemon=True)
+  thread.start()
+  try:
+    while True:
+      (finished, item) = buffer.get()
+      if finished:
+        if item is not None:
+          raise item
+        return
+      yield item
+  finally:
+    stop.set()
+    if thread is not threading.current_thread():
+      thread.join()
+
+
+def _check_policy_inputs_shapes(obs, act, advantages, old_logps, mask):
+  """Shape checks to help debugging."""
+  if len(advantages.shape) != 2:
+    raise ValueError('Advantages are expected to have shape ' +
+                     '[batch_size, length], got: %s' % str(advantages.shape))
+  if act.shape[0:2] != advantages.shape:
+    raise ValueError('First 2 dimensions of actions should be the same as in '
+                     'advantages, %s != %s' % (act.shape[0:2],
+                                               advantages.shape))
+  if obs.shape[0:2] != advantages.shape:
+    raise ValueError('First 2 dimensions of observations should be the same '
+                     'as in advantages, %s != %s' % (obs.shape[0:2],
+                                                     advantages.shape))
+  if old_logps.shape != advantages.shape:
+    raise ValueError('Old log-probs and advantages shapes should be the same'
+                     ', %s != %s' % (old_logps.shape, advantages.shape))
+  if mask.shape != advantages.shape:
+    raise ValueError('Mask and advantages shapes should be the same'
+                     ', %s != %s' % (mask.shape, advantages.shape))
 
 
 ### Implementations of common actor-critic algorithms.
@@ -317,41 +632,46 @@ class AdvantageBasedActorCriticTrainer(ActorCriticTrainer):
     self._advantage_estimator = advantage_estimator
     self._advantage_normalization = advantage_normalization
     self._advantage_normalization_epsilon = advantage_normalization_epsilon
+    # Shape checks in policy_inputs only run on the first batch, unless the
+    # TRAX_DEBUG environment variable is set.
+    self._policy_inputs_checked = False
+    self._always_check_policy_inputs = bool(os.environ.get('TRAX_DEBUG'))
+    self._policy_inputs_jit = math.jit(self._policy_inputs_fn)
     super(AdvantageBasedActorCriticTrainer, self).__init__(task, **kwargs)
 
+  def _policy_inputs_fn(self, observations, actions, log_probs, rewards,
+                        returns, mask, values):
+    """Computes a policy model batch from a trajectory batch; to be jitted."""
+    advantages = self._advantages_fn(rewards, returns, values)
+    # Observations should be the same length as advantages - so if we are
+    # using n_extra_steps, we need to trim the length to match.
+    length = advantages.shape[1]
+    return (
+        observations[:, :length],
+        actions[:, :length],
+        advantages,
+        log_probs[:, :length],
+        # Mask to zero-out padding. It is made boolean once here, as the
+        # losses only use it to select timesteps in reductions.
+        mask[:, :length] != 0,
+    )
+
   def policy_inputs(self, trajectory, values):
     """Create inputs to policy model from a TrajectoryNp and values."""
-    # How much TD to use is determined by the added policy slice length,
-    # as the policy batches need to be this much longer to calculate TD.
-    advantages = self._advantage_estimator(
-        trajectory.rewards, trajectory.returns, values,
-        gamma=self._task.gamma,
-        n_extra_steps=self._added_policy_slice_length,
+    # Slicing happens on device, so the trimmed tail of the trajectory is
+    # never copied and the batch stays on device for the policy trainer.
+    (obs, act, advantages, old_logps, mask) = self._policy_inputs_jit(
+        trajectory.observations,
+        trajectory.actions,
+        trajectory.log_probs,
+        trajectory.rewards,
+        trajectory.returns,
+        trajectory.mask,
+        values,
     )
-    # Observations should be the same length as advantages - so if we are
-    # using n_extra_steps, we need to trim the length to match.
-    obs = trajectory.observations[:, :advantages.shape[1]]
-    act = trajectory.actions[:, :advantages.shape[1]]
-    old_logps = trajectory.log_probs[:, :advantages.shape[1]]
-    mask = trajectory.mask[:, :advantages.shape[1]]  # Mask to zero-out padding.
-    # Shape checks to help debugging.
-    if len(advantages.shape) != 2:
-      raise ValueError('Advantages are expected to have shape ' +
-                       '[batch_size, length], got: %s' % str(advantages.shape))
-    if act.shape[0:2] != advantages.shape:
-      raise ValueError('First 2 dimensions of actions should be the same as in '
-                       'advantages, %s != %s' % (act.shape[0:2],
-                                                 advantages.shape))
-    if obs.shape[0:2] != advantages.shape:
-      raise ValueError('First 2 dimensions of observations should be the same '
-                       'as in advantages, %s != %s' % (obs.shape[0:2],
-                                                       advantages.shape))
-    if old_logps.shape != advantages.shape:
-      raise ValueError('Old log-probs and advantages shapes should be the same'
-                       ', %s != %s' % (old_logps.shape, advantages.shape))
-    if mask.shape != advantages.shape:
-      raise ValueError('Mask and advantages shapes should be the same'
-                       ', %s != %s' % (mask.shape, advantages.shape))
+    if not self._policy_inputs_checked or self._always_check_policy_inputs:
+      _check_policy_inputs_shapes(obs, act, advantages, old_logps, mask)
+      self._policy_inputs_checked = True
     return (obs, act, advantages, old_logps, mask)
 
   @property
@@ -362,22 +682,17 @@ class AdvantageBasedActorCriticTrainer(ActorCriticTrainer):
   @property
   def policy_loss(self, **unused_kwargs):
     """Policy loss."""
-    def NormalizeAdvantages():  # pylint: disable=invalid-name
-      def normalize(adv):
-        return (
-            (adv - jnp.mean(adv)) /
-            (jnp.std(adv) + self._advantage_normalization_epsilon)
-        )
-      return tl.Fn('NormalizeAdvantages', normalize)
-
+    if self._advantage_normalization:
+      normalize_advantages = NormalizeAdvantages(
+          self._advantage_normalization_epsilon)
+    else:
+      normalize_advantages = []
     return tl.Serial(
         self._policy_dist.LogProb(),
         tl.Parallel(
             [],  # Distribution inputs.
-            # Advantages.
-            NormalizeAdvantages() if self._advantage_normalization else [],
-            [],  # Old log probs.
-            [],  # Mask.
+            # Advantages, old log probs and mask.
+            normalize_advantages,
         ),
         self.policy_loss_given_log_probs,
     )
@@ -395,25 +710,38 @@ class AdvantageBasedActorCriticTrainer(ActorCriticTrainer):
   def advantage_mean(self):
     return tl.Serial([
         # (dist_inputs, advantages, old_log_probs, mask)
-        tl.Select([1]),  # Select just the advantages.
-        tl.Fn('AdvantageMean', lambda x: jnp.mean(x)),  # pylint: disable=unnecessary-lambda
+        tl.Select([1, 3]),  # Select the advantages and the mask.
+        # Padded timesteps are excluded from the statistics.
+        tl.Fn('AdvantageMean', lambda x, mask: jnp.mean(x, where=mask)),
     ])
 
   @property
   def advantage_std(self):
     return tl.Serial([
         # (dist_inputs, advantages, old_log_probs, mask)
-        tl.Select([1]),  # Select just the advantages.
-        tl.Fn('AdvantageStd', lambda x: jnp.std(x)),  # pylint: disable=unnecessary-lambda
+        tl.Select([1, 3]),  # Select the advantages and the mask.
+        tl.Fn('AdvantageStd', lambda x, mask: jnp.std(x, where=mask)),
     ])
 
 
+def NormalizeAdvantages(epsilon):  # pylint: disable=invalid-name
+  """Normalizes advantages to zero mean and unit std over unpadded timesteps."""
+  def f(advantages, old_log_probs, mask):
+    # Both moments are computed from the same read of advantages, and the
+    # variance is clipped at 0 against rounding errors.
+    mean = jnp.mean(advantages, where=mask)
+    mean_of_squares = jnp.mean(advantages * advantages, where=mask)
+    std = jnp.sqrt(jnp.maximum(mean_of_squares - mean * mean, 0.0))
+    return ((advantages - mean) / (std + epsilon), old_log_probs, mask)
+  return tl.Fn('NormalizeAdvantages', f, n_out=3)
+
+
 # A2C is one of the most basic actor-critic RL algorithms.
 def A2CLoss():  # pylint: disable=invalid-name
   """Definition of the Advantage Actor Critic (A2C) loss."""
   def f(log_probs, advantages, old_log_probs, mask):
     del old_log_probs  # Not used in A2C.
-    return -jnp.sum(log_probs * advantages * mask) / jnp.sum(mask)
+    return -jnp.mean(log_probs * advantages, where=mask)
   return tl.Fn('A2CLoss', f)
 
 
@@ -438,12 +766,14 @@ def PPOLoss(epsilon):  # pylint: disable=invalid-name
     # The ratio between new_probs and old_probs expressed
     # using log_probs and exponentaion
     probs_ratio = jnp.exp(new_log_probs - old_log_probs)
-    unclipped_objective = probs_ratio * advantages
-    clipped_objective = jnp.clip(probs_ratio,
-                                 1 - epsilon,
-                                 1 + epsilon) * advantages
-    ppo_objective = jnp.minimum(unclipped_objective, clipped_objective)
-    return -jnp.sum(ppo_objective * mask) / jnp.sum(mask)
+    # min(ratio * adv, clip(ratio, 1 - eps, 1 + eps) * adv) only ever clips
+    # the ratio from above for non-negative advantages and from below for
+    # negative ones, so it reduces to a single select.
+    clipped_ratio = jnp.where(advantages >= 0,
+                              jnp.minimum(probs_ratio, 1 + epsilon),
+                              jnp.maximum(probs_ratio, 1 - epsilon))
+    ppo_objective = clipped_ratio * advantages
+    return -jnp.mean(ppo_objective, where=mask)
   return tl.Fn('PPOLoss', f)
 
 
@@ -471,13 +801,21 @@ def awr_weights(advantages, beta):
   return jnp.exp(advantages / beta)
 
 
+def AWRWeights(beta, w_max):  # pylint: disable=invalid-name
+  """Layer computing AWR weights from advantages, clipped at w_max."""
+  return tl.Fn(
+      'AWRWeights', lambda x: jnp.minimum(awr_weights(x, beta), w_max))
+
+
 def AWRLoss(beta, w_max):  # pylint: disable=invalid-name
   """Definition of the Advantage Weighted Regression (AWR) loss."""
-  def f(log_probs, advantages, old_log_probs, mask):
+  def f(log_probs, weights, old_log_probs, mask):
     del old_log_probs  # Not used in AWR.
-    weights = jnp.minimum(awr_weights(advantages, beta), w_max)
-    return -jnp.sum(log_probs * weights * mask) / jnp.sum(mask)
-  return tl.Fn('AWRLoss', f)
+    return -jnp.mean(log_probs * weights, where=mask)
+  return tl.Serial(
+      tl.Parallel([], AWRWeights(beta, w_max)),  # Advantages -> weights.
+      tl.Fn('AWRLoss', f),
+  )
 
 
 class AWRTrainer(AdvantageBasedActorCriticTrainer):
@@ -499,22 +837,26 @@ class AWRTrainer(AdvantageBasedActorCriticTrainer):
   @property
   def policy_metrics(self):
     metrics = super(AWRTrainer, self).policy_metrics
+    # AWR weights lie in (0, w_max], so these initial values do not change the
+    # min and max, but make them defined for fully padded batches.
     metrics.update({  # pylint: disable=g-complex-comprehension
         'awr_weight_' + name: self.awr_weight_stat(name, fn)
         for (name, fn) in [
             ('mean', jnp.mean),
             ('std', jnp.std),
-            ('min', jnp.min),
-            ('max', jnp.max),
+            ('min', functools.partial(jnp.min, initial=self._w_max)),
+            ('max', functools.partial(jnp.max, initial=0.0)),
         ]
     })
     return metrics
 
   def awr_weight_stat(self, stat_name, stat_fn):
+    # The same AWRWeights computation is used by every stat and by the loss, so
+    # XLA can share it when the metrics are jitted together.
     return tl.Serial([
-        tl.Select([1]),  # Select just the advantages.
-        tl.Fn(
-            'AWRWeight' + stat_name.capitalize(),
-            lambda x: stat_fn(awr_weights(x, self._beta)),
-        ),
+        tl.Select([1, 3]),  # Select the advantages and the mask.
+        AWRWeights(self._beta, self._w_max),
+        # Padded timesteps are excluded from the statistics.
+        tl.Fn('AWRWeight' + stat_name.capitalize(),
+              lambda x, mask: stat_fn(x, where=mask)),
     ])
@@ -18,19 +18,35 @@
 
 import functools
 import math
+import threading
 
 from absl.testing import absltest
+import jax
+import numpy as np
 
 from trax import layers as tl
 from trax import lr_schedules
 from trax import models
 from trax import optimizers as opt
 from trax import test_utils
+from trax.math import numpy as jnp
 from trax.rl import actor_critic
 from trax.rl import advantages
 from trax.rl import task as rl_task
 
 
+def _trajectory_batch(batch_size, length, value=0.0):
+  """Makes a TrajectoryNp batch with observations filled with value."""
+  return rl_task.TrajectoryNp(
+      observations=np.full((batch_size, length, 4), value, dtype=np.float32),
+      actions=np.zeros((batch_size, length), dtype=np.int32),
+      log_probs=np.zeros((batch_size, length), dtype=np.float32),
+      rewards=np.zeros((batch_size, length), dtype=np.float32),
+      returns=np.zeros((batch_size, length), dtype=np.float32),
+      mask=np.ones((batch_size, length), dtype=np.float32),
+  )
+
+
 class ActorCriticTest(absltest.TestCase):
 
   def setUp(self):
@@ -83,6 +99,183 @@ class ActorCriticTest(absltest.TestCase):
     trainer1.close()
     trainer2.close()
 
+  def test_grouped_value_eval(self):
+    """Check that mixed-shape batches are grouped and split back in order."""
+    batches = [
+        _trajectory_batch(2, 3, value=0),
+        _trajectory_batch(1, 5, value=1),
+        _trajectory_batch(3, 3, value=2),
+        _trajectory_batch(2, 3, value=3),
+        _trajectory_batch(1, 5, value=4),
+    ]
+    call_batch_sizes = []
+    def value_eval_fn(batch):
+      call_batch_sizes.append(batch.observations.shape[0])
+      return (batch.observations[:, :, 0], batch.mask)
+    outputs = actor_critic._grouped_value_eval(batches, value_eval_fn)
+    # One call per distinct shape: two (2, 3) batches and two (1, 5) batches
+    # are merged, the (3, 3) batch is evaluated alone.
+    self.assertCountEqual(call_batch_sizes, [4, 2, 3])
+    self.assertLen(outputs, len(batches))
+    for (batch, (values, mask)) in zip(batches, outputs):
+      np.testing.assert_array_equal(values, batch.observations[:, :, 0])
+      np.testing.assert_array_equal(mask, batch.mask)
+
+  def test_value_eval_prefetch_must_be_positive(self):
+    task = rl_task.RLTask('CartPole-v0', initial_trajectories=1,
+                          max_steps=2)
+    body = lambda mode: tl.Serial(tl.Dense(64), tl.Relu())
+    policy_model = functools.partial(models.Policy, body=body)
+    value_model = functools.partial(models.Value, body=body)
+    with self.assertRaises(ValueError):
+      actor_critic.A2CTrainer(
+          task,
+          value_model=value_model,
+          policy_model=policy_model,
+          value_eval_prefetch=0)
+
+  def test_background_stream_order(self):
+    stream = actor_critic._background_stream(iter(range(10)), buffer_size=2)
+    self.assertEqual(list(stream), list(range(10)))
+
+  def test_background_stream_reraises(self):
+    def failing_stream():
+      yield 0
+      yield 1
+      raise ValueError('stream failed')
+    stream = actor_critic._background_stream(failing_stream(), buffer_size=1)
+    self.assertEqual(next(stream), 0)
+    self.assertEqual(next(stream), 1)
+    with self.assertRaisesRegex(ValueError, 'stream failed'):
+      next(stream)
+
+  def test_background_stream_close_joins_thread(self):
+    producer_threads = []
+    def infinite_stream():
+      producer_threads.append(threading.current_thread())
+      i = 0
+      while True:
+        yield i
+        i += 1
+    stream = actor_critic._background_stream(infinite_stream(), buffer_size=2)
+    self.assertEqual([next(stream) for _ in range(3)], [0, 1, 2])
+    (producer_thread,) = producer_threads
+    self.assertIsNot(producer_thread, threading.current_thread())
+    stream.close()
+    self.assertFalse(producer_thread.is_alive())
+
+  def test_value_eval_stream_drops_stale_batches(self):
+    """Check that batches from an outdated target network are dropped."""
+    task = rl_task.RLTask('CartPole-v0', initial_trajectories=1,
+                          max_steps=2)
+    body = lambda mode: tl.Serial(tl.Dense(64), tl.Relu())
+    policy_model = functools.partial(models.Policy, body=body)
+    value_model = functools.partial(models.Value, body=body)
+    trainer = actor_critic.A2CTrainer(
+        task,
+        value_model=value_model,
+        value_optimizer=opt.Adam,
+        value_batch_size=2,
+        policy_model=policy_model,
+        policy_optimizer=opt.Adam,
+        policy_batch_size=2,
+        value_eval_prefetch=4)
+    batches = [_trajectory_batch(2, 3, value=i) for i in range(6)]
+    stream = trainer._value_eval_stream(
+        iter(batches), lambda batch: batch.observations)
+    (first_batch, _) = next(stream)
+    # Batches 1-3 were evaluated together with batch 0, so they become stale.
+    trainer._update_target_value_network()
+    values = [first_batch.observations[0, 0, 0]]
+    for (batch, output) in stream:
+      np.testing.assert_array_equal(output, batch.observations)
+      values.append(batch.observations[0, 0, 0])
+    self.assertEqual(values, [0, 4, 5])
+    trainer.close()
+
+  def test_value_eval_dtype(self):
+    """Check the reduced-precision target network against float32."""
+    task = rl_task.RLTask('CartPole-v0', initial_trajectories=1,
+                          max_steps=2)
+    body = lambda mode: tl.Serial(tl.Dense(64), tl.Relu())
+    policy_model = functools.partial(models.Policy, body=body)
+    value_model = functools.partial(models.Value, body=body)
+    def make_trainer(value_eval_dtype):
+      return actor_critic.A2CTrainer(
+          task,
+          value_model=value_model,
+          value_optimizer=opt.Adam,
+          value_batch_size=2,
+          policy_model=policy_model,
+          policy_optimizer=opt.Adam,
+          policy_batch_size=2,
+          value_eval_dtype=value_eval_dtype)
+    bf16_trainer = make_trainer(jnp.bfloat16)
+    f32_trainer = make_trainer(None)
+    # Evaluate the same target network in both precisions.
+    (weights, state) = f32_trainer._value_eval_weights_and_state
+    bf16_trainer._set_target_value_network(weights, state)
+    # The target network weights are stored cast, not cast on every call.
+    (bf16_weights, _) = bf16_trainer._value_eval_weights_and_state
+    for (x, bf16_x) in zip(jax.tree_util.tree_leaves(weights),
+                           jax.tree_util.tree_leaves(bf16_weights)):
+      self.assertEqual(x.dtype, np.float32)
+      self.assertEqual(bf16_x.dtype, jnp.bfloat16)
+
+    observations = np.random.uniform(
+        -1.0, 1.0, size=(2, 3, 4)).astype(np.float32)
+    mask = np.array([[1, 1, 1], [1, 1, 0]], dtype=np.float32)
+    values = bf16_trainer._value_eval(observations, mask)
+    expected_values = f32_trainer._value_eval(observations, mask)
+    self.assertEqual(values.dtype, np.float32)
+    self.assertEqual(values.shape, (2, 3))
+    np.testing.assert_allclose(values, expected_values, rtol=5e-2, atol=5e-2)
+    bf16_trainer.close()
+    f32_trainer.close()
+
+  def test_normalize_advantages(self):
+    """Check that advantage statistics ignore the padded timesteps."""
+    epsilon = 1e-5
+    advantages = np.array([[1.0, -2.0, 3.0, 0.0],
+                           [0.5, 4.0, 0.0, 0.0]], dtype=np.float32)
+    old_log_probs = np.zeros((2, 4, 1), dtype=np.float32)
+    mask = np.array([[1, 1, 1, 0], [1, 1, 0, 0]], dtype=bool)
+    layer = actor_critic.NormalizeAdvantages(epsilon)
+    (normalized, _, _) = layer((advantages, old_log_probs, mask))
+
+    # Padded timesteps should not influence the statistics.
+    padded_advantages = np.where(mask, advantages, 100.0).astype(np.float32)
+    (padded_normalized, _, _) = layer(
+        (padded_advantages, old_log_probs, mask))
+    np.testing.assert_allclose(
+        np.asarray(padded_normalized)[mask], np.asarray(normalized)[mask],
+        rtol=1e-5)
+
+    unpadded = advantages[mask]
+    expected = (unpadded - unpadded.mean()) / (unpadded.std() + epsilon)
+    np.testing.assert_allclose(
+        np.asarray(normalized)[mask], expected, rtol=1e-4, atol=1e-5)
+
+  def test_ppo_loss(self):
+    """Check PPOLoss against the min(ratio * adv, clip(ratio) * adv) form."""
+    epsilon = 0.2
+    new_log_probs = np.log(np.array([[0.5, 1.0, 1.5, 2.0],
+                                     [0.7, 1.1, 1.3, 0.9]], dtype=np.float32))
+    old_log_probs = np.zeros((2, 4, 1), dtype=np.float32)
+    # Positive, negative and zero advantages on both sides of the clip range.
+    advantages = np.array([[1.0, -1.0, 2.0, -3.0],
+                           [-0.5, 0.0, 1.5, 5.0]], dtype=np.float32)
+    mask = np.array([[1, 1, 1, 1], [1, 1, 1, 0]], dtype=bool)
+    loss = actor_critic.PPOLoss(epsilon)(
+        (new_log_probs, advantages, old_log_probs, mask))
+
+    ratio = np.exp(new_log_probs - old_log_probs[..., 0])
+    objective = np.minimum(
+        ratio * advantages,
+        np.clip(ratio, 1 - epsilon, 1 + epsilon) * advantages)
+    expected_loss = -np.mean(objective[mask])
+    np.testing.assert_allclose(loss, expected_loss, rtol=1e-5)
+
   def test_sanity_a2ctrainer_cartpole(self):
     """Test-runs a2c on cartpole."""
     task = rl_task.RLTask('CartPole-v0', initial_trajectories=1,
@@ -19,6 +19,9 @@
 import gin
 import numpy as np
 
+from trax import math
+from trax.math import numpy as jnp
+
 
 common_args = ['rewards', 'returns', 'values', 'gamma', 'n_extra_steps']
 
@@ -100,13 +103,24 @@ def td_lambda(rewards, returns, values, gamma, n_extra_steps, lambda_=0.95):
   Returns:
     the advantages, a tensor of shape [batch_size, length - n_extra_steps].
   """
-  td_returns = np.zeros_like(returns)
   (_, length) = returns.shape
-  td_returns[:, -1] = values[:, -1]
-  for i in reversed(range(length - 1)):
-    td_returns[:, i] = rewards[:, i] + gamma * (
-        (1 - lambda_) * values[:, i + 1] + lambda_ * td_returns[:, i + 1]
+  def td_step(step_inputs, next_td_return):
+    (reward, next_value) = step_inputs
+    td_return = reward + gamma * (
+        (1 - lambda_) * next_value + lambda_ * next_td_return
     )
+    return (td_return, td_return)
+  # Scan backwards in time over time-major arrays of shape [length, batch_size],
+  # starting from the value of the last state.
+  reversed_inputs = (
+      jnp.flip(rewards.T[:(length - 1)], axis=0),
+      jnp.flip(values.T[1:], axis=0),
+  )
+  (reversed_td_returns, _) = math.scan(
+      td_step, reversed_inputs, values[:, -1])
+  td_returns = jnp.concatenate(
+      [jnp.flip(reversed_td_returns, axis=0), values.T[-1:]], axis=0
+  ).T
   return (td_returns - values)[:, :(returns.shape[1] - n_extra_steps)]
 
 
@@ -95,6 +95,15 @@ class AdvantagesTest(parameterized.TestCase):
     adv2 = advantages.discount_gae(rewards, values, gamma=1, n_extra_steps=2)
     self.assertEqual(adv2.shape, (1, 1))
 
+  def test_td_lambda_values(self):
+    rewards = np.array([[1, 1, 1]], dtype=np.float32)
+    returns = np.array([[3, 2, 1]], dtype=np.float32)
+    values = np.array([[2, 2, 2]], dtype=np.float32)
+    adv = advantages.td_lambda(
+        rewards, returns, values, gamma=1, n_extra_steps=0, lambda_=0.5
+    )
+    np.testing.assert_allclose(adv, [[1.5, 1, 0]])
+
   def test_monte_carlo_bias_is_zero(self):
     (bias, _) = estimate_advantage_bias_and_variance(
         advantages.monte_carlo, n_extra_steps=3
@@ -197,27 +197,21 @@ def play(env, policy, dm_suite=False, max_steps=None):
   return cur_trajectory
 
 
-def _zero_pad(x, pad, axis):
-  """Helper for np.pad with 0s for single-axis case."""
-  pad_widths = [(0, 0)] * len(x.shape)
-  pad_widths[axis] = pad  # Padding on axis.
-  return np.pad(x, pad_widths, mode='constant',
-                constant_values=x.dtype.type(0))
-
-
 def _random_policy(action_space):
   # TODO(pkozakowski): Make returning the log probabilities optional.
   # Returning 1 as a log probability is a temporary hack.
   return lambda _: (action_space.sample(), 1.0)
 
 
-def _sample_proportionally(inputs, weights):
+def _sample_proportionally(inputs, weights, rng=None):
   """Sample an element from the inputs list proportionally to weights.
 
   Args:
     inputs: a list, we will return one element of this list.
     weights: a list of numbers of the same length as inputs; we will sample
       the k-th input with probability weights[k] / sum(weights).
+    rng: a np.random.RandomState to sample with; the global numpy random
+      state is used if None.
 
   Returns:
     an element from inputs.
@@ -228,7 +222,9 @@ def _sample_proportionally(inputs, weights):
                      f': {l} != {len(weights)}')
   weights_sum = float(sum(weights))
   norm_weights = [w / weights_sum for w in weights]
-  idx = np.random.choice(l, p=norm_weights)
+  if rng is None:
+    rng = np.random
+  idx = rng.choice(l, p=norm_weights)
   return inputs[int(idx)]
 
 
@@ -425,7 +421,8 @@ class RLTask:
 
   def trajectory_stream(self, epochs=None, max_slice_length=None,
                         include_final_state=False,
-                        sample_trajectories_uniformly=False):
+                        sample_trajectories_uniformly=False,
+                        rng=None):
     """Return a stream of random trajectory slices from the specified epochs.
 
     Args:
@@ -435,12 +432,16 @@ class RLTask:
         the trajectory which may have no action and reward
       sample_trajectories_uniformly: whether to sample trajectories uniformly,
        or proportionally to the number of slices in each trajectory (default)
+      rng: a np.random.RandomState to sample with; the global numpy random
+        state is used if None
 
     Yields:
       random trajectory slices sampled uniformly from all slices of length
       upto max_slice_length in all specified epochs
     """
     # TODO(lukaszkaiser): add option to sample from n last trajectories.
+    if rng is None:
+      rng = np.random
     end_offset = 0 if include_final_state else 1
     def n_slices(t):
       """How many slices of length upto max_slice_length in a trajectory."""
@@ -469,7 +470,8 @@ class RLTask:
       else:
         slices_per_epoch = [sum([n_slices(t) for t in self._trajectories[ep]])
                             for ep in epoch_indices]
-        epoch_id = _sample_proportionally(epoch_indices, slices_per_epoch)
+        epoch_id = _sample_proportionally(
+            epoch_indices, slices_per_epoch, rng=rng)
       epoch = self._trajectories[epoch_id]
 
       # Sample a trajectory proportionally to number of slices in each one.
@@ -477,10 +479,11 @@ class RLTask:
         slices_per_trajectory = [1] * len(epoch)
       else:
         slices_per_trajectory = [n_slices(t) for t in epoch]
-      trajectory = _sample_proportionally(epoch, slices_per_trajectory)
+      trajectory = _sample_proportionally(
+          epoch, slices_per_trajectory, rng=rng)
 
       # Sample a slice from the trajectory.
-      slice_start = np.random.randint(n_slices(trajectory))
+      slice_start = rng.randint(n_slices(trajectory))
       slice_end = slice_start + (max_slice_length or len(trajectory))
       slice_end = min(slice_end, len(trajectory) - end_offset)
       yield trajectory[slice_start:slice_end]
@@ -489,7 +492,9 @@ class RLTask:
                               max_slice_length=None,
                               min_slice_length=None,
                               include_final_state=False,
-                              sample_trajectories_uniformly=False):
+                              sample_trajectories_uniformly=False,
+                              padding_length=None,
+                              rng=None):
     """Return a stream of trajectory batches from the specified epochs.
 
     This function returns a stream of tuples of numpy arrays (tensors).
@@ -504,6 +509,11 @@ class RLTask:
         the trajectory which may have no action and reward
       sample_trajectories_uniformly: whether to sample trajectories uniformly,
        or proportionally to the number of slices in each trajectory (default)
+      padding_length: if set, always pad tensors to (at least) this length, so
+        that batches have fixed shapes; otherwise tensors of different lengths
+        are padded to the next power of 2
+      rng: a np.random.RandomState to sample with; the global numpy random
+        state is used if None
 
     Yields:
       batches of trajectory slices sampled uniformly from all slices of length
@@ -513,16 +523,26 @@ class RLTask:
     def pad(tensor_list):
       max_len = max([t.shape[0] for t in tensor_list])
       min_len = min([t.shape[0] for t in tensor_list])
-      if max_len == min_len:  # No padding needed.
+      if padding_length is not None:
+        pad_len = max(padding_length, max_len)
+      elif max_len != min_len:
+        pad_len = 2**int(np.ceil(np.log2(max_len)))
+      else:
+        pad_len = max_len
+      if pad_len == min_len:  # No padding needed.
         return np.array(tensor_list)
-
-      pad_len = 2**int(np.ceil(np.log2(max_len)))
-      return np.array([_zero_pad(t, (0, pad_len - t.shape[0]), axis=0)
-                       for t in tensor_list])
+      # Write each tensor straight into the padded batch, instead of padding
+      # them one by one and copying again when stacking.
+      first = tensor_list[0]
+      padded = np.zeros((len(tensor_list), pad_len) + first.shape[1:],
+                        dtype=first.dtype)
+      for (row, t) in zip(padded, tensor_list):
+        row[:t.shape[0]] = t
+      return padded
     cur_batch = []
     for t in self.trajectory_stream(
         epochs, max_slice_length,
-        include_final_state, sample_trajectories_uniformly):
+        include_final_state, sample_trajectories_uniformly, rng=rng):
       # TODO(pkozakowski): Instead sample the trajectories out of those with
       # the minimum length.
       if min_slice_length is not None and len(t) < min_slice_length:
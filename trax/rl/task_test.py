@@ -114,6 +114,39 @@ class TaskTest(absltest.TestCase):
     self.assertLen(next_slice, 2)
     self.assertEqual(next_slice.last_observation.shape, (12, 13))
 
+  def test_trajectory_batch_stream_padding_length(self):
+    """Test padding trajectory batches to a fixed length."""
+    elem = np.zeros((2,))
+    tr1 = rl_task.Trajectory(elem)
+    tr1.extend(0, 0, 0, elem)
+    task = rl_task.RLTask(DummyEnv(), initial_trajectories=[tr1], max_steps=9)
+    stream = task.trajectory_batch_stream(
+        2, max_slice_length=4, padding_length=4)
+    batch = next(stream)
+    self.assertEqual(batch.observations.shape, (2, 4, 2))
+    self.assertEqual(batch.actions.shape, (2, 4))
+    np.testing.assert_array_equal(batch.mask, [[1, 0, 0, 0], [1, 0, 0, 0]])
+
+  def test_trajectory_batch_stream_rng(self):
+    """Test that streams sampling with equal rngs give equal batches."""
+    trajectories = []
+    for i in range(3):
+      tr = rl_task.Trajectory(i)
+      for j in range(5):
+        tr.extend(0, 0, 0, 10 * i + j)
+      trajectories.append(tr)
+    task = rl_task.RLTask(
+        DummyEnv(), initial_trajectories=trajectories, max_steps=9)
+    stream1 = task.trajectory_batch_stream(
+        2, max_slice_length=2, rng=np.random.RandomState(0))
+    stream2 = task.trajectory_batch_stream(
+        2, max_slice_length=2, rng=np.random.RandomState(0))
+    for _ in range(5):
+      batch1 = next(stream1)
+      np.random.rand()  # The global random state should not be used.
+      batch2 = next(stream2)
+      np.testing.assert_array_equal(batch1.observations, batch2.observations)
+
   def test_trajectory_stream_final_state(self):
     """Test trajectory stream with and without the final state."""
     tr1 = rl_task.Trajectory(0)
@@ -203,13 +203,68 @@ class Trainer(object):
 
   @model_weights.setter
   def model_weights(self, weights):
-    new_model_weights = self._for_n_devices(weights)
+    self.replicated_model_weights = self._for_n_devices(weights)
+
+  @property
+  def replicated_model_weights(self):
+    """Model weights as used in training, replicated if n_devices > 1."""
+    return self._opt_state.weights[0]
+
+  @replicated_model_weights.setter
+  def replicated_model_weights(self, new_model_weights):
     if isinstance(self._opt_state.weights, list):
       self._opt_state.weights[0] = new_model_weights
     else:  # weights are a tuple, need to re-create
       new_weights = [new_model_weights] + list(self._opt_state.weights[1:])
       self._opt_state = self._opt_state._replace(weights=new_weights)
 
+  def get_model_slots(self, start, end):
+    """Returns optimizer slots of the model sublayers [start:end].
+
+    Args:
+      start: index of the first sublayer of the model
+      end: index after the last sublayer of the model
+
+    Returns:
+      A list of optimizer slots, one per weight array of the sublayers, as used
+      in training, i.e. replicated if n_devices > 1.
+    """
+    (slots_start, slots_end) = self._model_slots_range(start, end)
+    return list(self._opt_state.slots[slots_start:slots_end])
+
+  def set_model_slots(self, start, end, new_slots):
+    """Sets optimizer slots of the model sublayers [start:end].
+
+    Args:
+      start: index of the first sublayer of the model
+      end: index after the last sublayer of the model
+      new_slots: a list of optimizer slots in the format returned by
+        get_model_slots
+    """
+    (slots_start, slots_end) = self._model_slots_range(start, end)
+    if len(new_slots) != slots_end - slots_start:
+      raise ValueError(
+          f'Sublayers [{start}:{end}] have {slots_end - slots_start} weight '
+          f'arrays, but {len(new_slots)} slots were given.')
+    if isinstance(self._opt_state.slots, list):
+      self._opt_state.slots[slots_start:slots_end] = new_slots
+    else:  # slots are a tuple, need to re-create
+      slots = list(self._opt_state.slots)
+      slots[slots_start:slots_end] = new_slots
+      self._opt_state = self._opt_state._replace(slots=slots)
+
+  def _model_slots_range(self, start, end):
+    """Returns the range of optimizer slots of the model sublayers."""
+    # The optimizer keeps a flat list of slots, one per weight array of the
+    # model with loss, in the order of its weight flattening. Model weights
+    # come first, as [0] is the model w/o loss.
+    def n_weight_arrays(weights):
+      return len(trax_opt.base._tree_flatten(weights))  # pylint: disable=protected-access
+    model_weights = self._opt_state.weights[0]
+    slots_start = n_weight_arrays(model_weights[:start])
+    slots_end = slots_start + n_weight_arrays(model_weights[start:end])
+    return (slots_start, slots_end)
+
   @property
   def model_state(self):
     # Currently we need to pick [0] as we ignore loss state (empty).
@@ -221,7 +276,15 @@ class Trainer(object):
 
   @model_state.setter
   def model_state(self, state):
-    new_model_state = self._for_n_devices(state)
+    self.replicated_model_state = self._for_n_devices(state)
+
+  @property
+  def replicated_model_state(self):
+    """Model state as used in training, replicated if n_devices > 1."""
+    return self._model_state[0]
+
+  @replicated_model_state.setter
+  def replicated_model_state(self, new_model_state):
     if isinstance(self._model_state, list):
       self._model_state[0] = new_model_state
     else:  # weights are a tuple, need to re-create
@@ -247,6 +247,72 @@ class TraxTest(test.TestCase, parameterized.TestCase):
       trainer.reset(output_dir2)
       trainer.evaluate(1)
 
+  def test_replicated_model_weights(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      model_fn = functools.partial(
+          models.MLP, d_hidden=16, n_output_classes=n_classes)
+      inputs = _test_inputs(n_classes)
+
+      trainer = trainer_lib.Trainer(
+          model=model_fn,
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.SM3,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=inputs,
+          output_dir=output_dir,
+      )
+
+      replicated_weights = trainer.replicated_model_weights
+      trainer.replicated_model_weights = math.nested_map(
+          np.zeros_like, replicated_weights)
+      math.nested_map(lambda x: self.assertAllEqual(x, np.zeros_like(x)),
+                      trainer.model_weights)
+
+      trainer.replicated_model_weights = replicated_weights
+      self.assertIs(trainer.replicated_model_weights, replicated_weights)
+      trainer.train_epoch(1, 1)
+
+  def test_model_slots(self):
+    with self.tmp_dir() as output_dir:
+      n_classes = 4
+      model_fn = lambda mode: layers.Serial(  # pylint: disable=g-long-lambda
+          layers.Flatten(), layers.Dense(3), layers.Relu(),
+          layers.Dense(n_classes))
+      inputs = _test_inputs(n_classes)
+
+      trainer = trainer_lib.Trainer(
+          model=model_fn,
+          loss_fn=layers.CrossEntropyLoss(),
+          optimizer=trax_opt.Adam,
+          lr_schedule=lr.MultifactorSchedule,
+          inputs=inputs,
+          output_dir=output_dir,
+      )
+
+      def unreplicated_shape(x):
+        return x.shape[1:] if trainer.n_devices > 1 else x.shape
+
+      # Adam has slots (m, v) for each of the kernel and the bias.
+      (kernel_slots, bias_slots) = trainer.get_model_slots(3, 4)
+      self.assertEqual([unreplicated_shape(x) for x in kernel_slots],
+                       [(3, n_classes)] * 2)
+      self.assertEqual([unreplicated_shape(x) for x in bias_slots],
+                       [(n_classes,)] * 2)
+      self.assertLen(trainer.get_model_slots(0, 2), 2)
+      self.assertEmpty(trainer.get_model_slots(2, 3))
+
+      # Only the slots of the selected sublayers should be replaced.
+      ones = math.nested_map(np.ones_like, trainer.get_model_slots(3, 4))
+      trainer.set_model_slots(3, 4, ones)
+      math.nested_map(lambda x: self.assertAllEqual(x, np.ones_like(x)),
+                      trainer.get_model_slots(3, 4))
+      math.nested_map(lambda x: self.assertAllEqual(x, np.zeros_like(x)),
+                      trainer.get_model_slots(0, 3))
+      with self.assertRaises(ValueError):
+        trainer.set_model_slots(0, 2, ones[:1])
+      trainer.train_epoch(1, 1)
+
   def test_tf_xla_forced_compile(self):
     # TODO(wangpeng): re-enable this test
     self.skipTest('Needs --config=cuda to pass this test')